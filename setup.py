@@ -76,6 +76,10 @@ setup(
         "jinja2>=2.11.3",
         "responses>=0.13.0"
     ],
+    extras_require={
+        # Faster parsing of JSON responses, see idpyoidc.client.service
+        "orjson": ["orjson"],
+    },
     zip_safe=False,
     cmdclass={'test': PyTest},
 )
@@ -1,7 +1,7 @@
 import hashlib
 import string
 
-SUCCESSFUL = [200, 201, 202, 203, 204, 205, 206]
+SUCCESSFUL = frozenset(range(200, 207))
 
 SERVICE_NAME = "OIC"
 CLIENT_CONFIG = {}
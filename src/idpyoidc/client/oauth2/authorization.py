@@ -58,8 +58,8 @@ class Authorization(Service):
         self.upstream_get("context").cstate.update(_key, request_args)
         return request_args
 
-    def gather_request_args(self, **kwargs):
-        ar_args = Service.gather_request_args(self, **kwargs)
+    def gather_request_args(self, ar_args: Optional[dict] = None, **kwargs):
+        ar_args = Service.gather_request_args(self, ar_args, **kwargs)
 
         if "redirect_uri" not in ar_args:
             try:
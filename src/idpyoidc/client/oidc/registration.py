@@ -1,4 +1,5 @@
 import logging
+from typing import Optional
 
 from cryptojwt import KeyJar
 
@@ -95,9 +96,10 @@ class Registration(Service):
         except KeyError:
             pass
 
-    def gather_request_args(self, **kwargs):
+    def gather_request_args(self, ar_args: Optional[dict] = None, **kwargs):
         """
 
+        @param ar_args:
         @param kwargs:
         @return:
         """
@@ -106,5 +108,7 @@ class Registration(Service):
         if "request_args" in self.conf:
             req_args.update(self.conf["request_args"])
 
+        if ar_args:
+            req_args.update(ar_args)
         req_args.update(kwargs)
         return req_args
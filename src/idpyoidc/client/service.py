@@ -1,16 +1,16 @@
 """ The basic Service class upon which all the specific services are built. """
 import copy
-import json
 import logging
+import re
 from typing import Callable
 from typing import List
 from typing import Optional
 from typing import Union
-from urllib.parse import urlparse
 
-from cryptojwt.jwe.jwe import factory as jwe_factory
-from cryptojwt.jws.jws import factory as jws_factory
 from cryptojwt.jwt import JWT
+from cryptojwt.utils import as_bytes
+from cryptojwt.utils import as_unicode
+from cryptojwt.utils import b64d
 
 from idpyoidc.client.exception import Unsupported
 from idpyoidc.exception import MissingSigningKey
@@ -31,18 +31,65 @@ from ..constant import JOSE_ENCODED
 from ..constant import JSON_ENCODED
 from ..constant import URL_ENCODED
 
+# orjson is an optional extra (pip install idpyoidc[orjson]).
+# Note that it differs from json when it comes to numbers: integers that don't
+# fit in 64 bits are returned as floats where json keeps them as int.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 __author__ = "Roland Hedberg"
 
 from ..context import OidcContext
 
 LOGGER = logging.getLogger(__name__)
 
-SUCCESSFUL = [200, 201, 202, 203, 204, 205, 206]
+SUCCESSFUL = frozenset(range(200, 207))
 
 SPECIAL_ARGS = ["authn_endpoint", "algs"]
 
+# Content type per request body type, anything else is sent as JSON
+BODY_CONTENT_TYPE = {
+    "urlencoded": URL_ENCODED,
+    "jws": JOSE_ENCODED,
+    "jwe": JOSE_ENCODED,
+    "jose": JOSE_ENCODED,
+}
+
 REQUEST_INFO = "Doing request with: URL:{}, method:{}, data:{}, https_args:{}"
 
+# Characters urlparse removes from a URL before splitting it
+URL_UNSAFE_CHARS = ["\t", "\r", "\n"]
+
+# Compact JWS (3 parts) or JWE (5 parts) serialization
+COMPACT_JOSE = re.compile(r"[\w-]+(\.[\w-]*){2}((\.[\w-]*){2})?", re.ASCII)
+
+
+def _looks_like_jwt(info) -> bool:
+    return isinstance(info, str) and COMPACT_JOSE.fullmatch(info) is not None
+
+
+def _detect_jose(info) -> str:
+    """
+    Find out whether a response is a compact JWS or JWE by looking at the JOSE header.
+
+    :param info: The response
+    :return: "jws", "jwe" or "" if it's neither
+    """
+    try:
+        _header = json_loads(b64d(as_bytes(as_unicode(info).split(".", 1)[0])))
+    except Exception:
+        return ""
+
+    if not isinstance(_header, dict):
+        return ""
+    if "enc" in _header:
+        return "jwe"
+    if "alg" in _header:
+        return "jws"
+    return ""
+
 
 class Service(ImpExp):
     """The basic Service class."""
@@ -84,6 +131,8 @@ class Service(ImpExp):
         self.upstream_get = upstream_get
         self.default_request_args = {}
         self.client_authn_methods = {}
+        self._callback_uris_cache = None
+        self._supports_cache = None
 
         if conf:
             self.conf = conf
@@ -99,10 +148,9 @@ class Service(ImpExp):
                 if param in conf:
                     setattr(self, param, conf[param])
 
-            _default_request_args = conf.get("request_args", {})
+            _default_request_args = conf.pop("request_args", None)
             if _default_request_args:
                 self.default_request_args = _default_request_args
-                del conf["request_args"]
 
             _client_authn_methods = conf.get("client_authn_methods", None)
             if _client_authn_methods:
@@ -127,16 +175,20 @@ class Service(ImpExp):
         self.construct_extra_headers = []
         self.post_parse_process = []
 
-    def gather_request_args(self, **kwargs):
+    def gather_request_args(self, ar_args: Optional[dict] = None, **kwargs):
         """
         Go through the attributes that the message class can contain and
         add values if they are missing but exists in the client info or
         when there are default values.
 
+        :param ar_args: Initial set of attributes. If given it is updated in place.
         :param kwargs: Initial set of attributes.
         :return: Possibly augmented set of attributes
         """
-        ar_args = kwargs.copy()
+        if ar_args is None:
+            ar_args = kwargs
+        elif kwargs:
+            ar_args.update(kwargs)
 
         _context = self.upstream_get("context")
         _use = _context.collect_usage()
@@ -152,16 +204,12 @@ class Service(ImpExp):
         # 1. A keyword argument
         # 2. configured set of default attribute values
         # 3. default attribute values defined in the OIDC standard document
+        _values = {**self.default_request_args, **{k: v for k, v in _use.items() if v}}
         for prop in self.msg_type.c_param:
             if prop in ar_args:
                 continue
 
-            val = _use.get(prop)
-            if not val:
-                # val = request_claim(_context, prop)
-                # if not val:
-                val = self.default_request_args.get(prop)
-
+            val = _values.get(prop)
             if val:
                 ar_args[prop] = val
 
@@ -177,14 +225,16 @@ class Service(ImpExp):
 
         :param context: Which service we're working for
         :param kwargs: A set of keyword arguments that are added at run-time.
-        :return: A set of keyword arguments
+        :return: A set of keyword arguments. Must be treated as read-only since it may
+            be the configured dictionary itself.
         """
         try:
-            _args = self.conf[context].copy()
+            _args = self.conf[context]
         except KeyError:
-            _args = kwargs
-        else:
-            _args.update(kwargs)
+            return kwargs
+
+        if kwargs:
+            return {**_args, **kwargs}
         return _args
 
     def do_pre_construct(self, request_args, **kwargs):
@@ -233,24 +283,38 @@ class Service(ImpExp):
         """
         pass
 
-    def construct(self, request_args: Optional[dict] = None, **kwargs):
+    def construct(
+            self,
+            request_args: Optional[dict] = None,
+            _context: Optional[OidcContext] = None,
+            **kwargs,
+    ):
         """
         Instantiate the request as a message class instance with
         attribute values gathered in a pre_construct method or in the
         gather_request_args method.
 
-        :param request_args:
+        :param request_args: Request arguments
+        :param _context: The service context, looked up if not given
         :param kwargs: extra keyword arguments
         :return: message class instance
         """
         if request_args is None:
+            _callers_args = None
             request_args = {}
+        else:
+            _callers_args = request_args
 
         # run the pre_construct methods. Will return a possibly new
         # set of request arguments but also a set of arguments to
         # be used by the post_construct methods.
         request_args, post_args = self.do_pre_construct(request_args, **kwargs)
 
+        # Below the request arguments are updated in place, so don't touch
+        # the dictionary the caller handed in.
+        if request_args is _callers_args:
+            request_args = dict(request_args)
+
         # If 'state' appears among the keyword argument and is not
         # expected to appear in the request, remove it.
         if "state" in self.msg_type.c_param and "state" in kwargs:
@@ -259,13 +323,13 @@ class Service(ImpExp):
                 request_args["state"] = kwargs["state"]
 
         # logger.debug("request_args: %s" % sanitize(request_args))
-        _args = self.gather_request_args(**request_args)
+        _args = self.gather_request_args(request_args)
 
         # logger.debug("kwargs: %s" % sanitize(kwargs))
 
         # we must check if claims module is idpyoidc.client.claims.oauth2recource as
         # in that case we don't want to set_defaults like application_type etc.
-        obj = self.upstream_get("context").claims
+        obj = (_context or self.upstream_get("context")).claims
         # initiate the request as in an instance of the self.msg_type
         # message type
         if(obj.__class__.__module__ == "idpyoidc.client.claims.oauth2resource"):
@@ -310,21 +374,19 @@ class Service(ImpExp):
 
         return http_args
 
-    def construct_request(self, request_args=None, **kwargs):
+    def construct_request(self, request_args=None, _context=None, **kwargs):
         """
         The method where everything is setup for sending the request.
         The request information is gathered and the where and how of sending the
         request is decided.
 
         :param request_args: Initial request arguments as a dictionary
+        :param _context: The service context, looked up if not given
         :param kwargs: Extra keyword arguments
         :return: A dictionary with the keys 'url' and possibly 'body', 'kwargs',
             'request' and 'ht_args'.
         """
-        if request_args is None:
-            request_args = {}
-
-        return self.construct(request_args, **kwargs)
+        return self.construct(request_args, _context=_context, **kwargs)
 
     def get_endpoint(self):
         """
@@ -377,30 +439,37 @@ class Service(ImpExp):
             request: Union[dict, Message],
             http_method: str,
             authn_method: Optional[str] = "",
+            _context: Optional[OidcContext] = None,
             **kwargs,
     ) -> dict:
         """
 
         :param request:
         :param authn_method:
+        :param _context: The service context, looked up if not given
         :param kwargs:
         :return:
         """
         if not authn_method:
             authn_method = self.get_authn_method()
 
-        _headers = self.get_authn_header(
-            request, authn_method=authn_method, authn_endpoint=self.endpoint_name, **kwargs
-        )
+        if authn_method:
+            _headers = self.get_authn_header(
+                request, authn_method=authn_method, authn_endpoint=self.endpoint_name, **kwargs
+            )
+
+            _authz = _headers.get("Authorization")
+            if _authz and _authz.startswith(("Bearer ", "DPoP ")):
+                kwargs["token"] = _authz.split(" ", 1)[1]
+        else:  # No client authentication, so no Authorization header
+            _headers = {}
 
-        _authz = _headers.get("Authorization")
-        if _authz:
-            if _authz.startswith("Bearer") or _authz.startswith("DPoP"):
-                kwargs["token"] = _authz.split(" ")[1]
+        if self.construct_extra_headers and _context is None:
+            _context = self.upstream_get("context")
 
         for meth in self.construct_extra_headers:
             _headers = meth(
-                self.upstream_get("context"),
+                _context,
                 headers=_headers,
                 request=request,
                 authn_method=authn_method,
@@ -441,13 +510,13 @@ class Service(ImpExp):
         if not request_body_type:
             request_body_type = self.request_body_type
 
-        request = self.construct_request(request_args=request_args, **kwargs)
+        _context = self.upstream_get("context")
+        request = self.construct_request(request_args=request_args, _context=_context, **kwargs)
 
         LOGGER.debug("Request: %s", request)
         _info = {"method": method, "request": request}
 
         _args = kwargs.copy()
-        _context = self.upstream_get("context")
         if _context.issuer:
             _args["iss"] = _context.issuer
 
@@ -462,19 +531,16 @@ class Service(ImpExp):
         # Client authentication by usage of the Authorization HTTP header
         # or by modifying the request object
         _args.update(self.get_headers_args())
-        _headers = self.get_headers(request, http_method=method, authn_method=authn_method, **_args)
+        _headers = self.get_headers(
+            request, http_method=method, authn_method=authn_method, _context=_context, **_args
+        )
 
         _info["url"] = get_http_url(endpoint_url, request, method=method)
 
         # If there is to be a body part
         if method == "POST":
             # How should it be serialized
-            if request_body_type == "urlencoded":
-                content_type = URL_ENCODED
-            elif request_body_type in ["jws", "jwe", "jose"]:
-                content_type = JOSE_ENCODED
-            else:  # request_body_type == 'json'
-                content_type = JSON_ENCODED
+            content_type = BODY_CONTENT_TYPE.get(request_body_type, JSON_ENCODED)
 
             _info["body"] = get_http_body(request, content_type)
 
@@ -497,12 +563,15 @@ class Service(ImpExp):
         """
         # If info is a whole URL pick out the query or fragment part
         if "?" in info or "#" in info:
-            parts = urlparse(info)
+            # Same split as urlparse. Tab and newline characters are removed, the
+            # fragment is everything after the first '#' and the query is whatever
+            # is between '?' and the fragment.
+            for _char in URL_UNSAFE_CHARS:
+                if _char in info:
+                    info = info.replace(_char, "")
+            _base, _, _fragment = info.partition("#")
             # either query of fragment
-            if parts.query:
-                info = parts.query
-            else:
-                info = parts.fragment
+            info = _base.partition("?")[2] or _fragment
         return info
 
     def post_parse_response(self, response, **kwargs):
@@ -539,8 +608,9 @@ class Service(ImpExp):
 
         return kwargs
 
-    def _do_jwt(self, info):
-        _context = self.upstream_get("context")
+    def _do_jwt(self, info, _context=None):
+        if _context is None:
+            _context = self.upstream_get("context")
         args = {"allowed_sign_algs": _context.get_sign_alg(self.service_name)}
         enc_algs = _context.get_enc_alg_enc(self.service_name)
         args["allowed_enc_algs"] = enc_algs["alg"]
@@ -550,8 +620,9 @@ class Service(ImpExp):
         _jwt.iss = _context.get_client_id()
         return _jwt.unpack(info)
 
-    def _do_response(self, info, sformat, **kwargs):
-        _context = self.upstream_get("context")
+    def _do_response(self, info, sformat, _context=None, **kwargs):
+        if _context is None:
+            _context = self.upstream_get("context")
 
         if isinstance(info, list):  # Don't have support for sformat=list
             return info
@@ -576,6 +647,48 @@ class Service(ImpExp):
                 raise ValueError(f"Incorrect message type: {sformat}")
         return resp
 
+    # Each of the _parse_* methods below returns a tuple of
+    # (info, sformat, JWS, JWE, response) to be used by parse_response.
+
+    def _parse_jose(self, info, context):
+        # can be jwe, jws or json
+        _jose_type = _detect_jose(info)
+        if _jose_type:
+            LOGGER.debug("%s detected", _jose_type)
+            _msg = self._do_jwt(info, _context=context)
+        else:
+            _msg = info
+        if _msg and isinstance(_msg, str):
+            _msg = json_loads(_msg)
+        return _msg, "dict", info, None, None
+
+    def _parse_jwe(self, info, context):
+        _keyjar = self.upstream_get("attribute", "keyjar")
+        _client_id = self.upstream_get("attribute", "client_id")
+        resp = self.response_cls().from_jwe(info, keys=_keyjar.get_issuer_keys(_client_id))
+        return info, "jwe", None, info, resp
+
+    def _parse_urlencoded(self, info, context):
+        # 'info' may be a URL in which case I have to get at the query/fragment part
+        return self.get_urlinfo(info), "urlencoded", None, None, None
+
+    def _parse_jwt(self, info, context):
+        return self._do_jwt(info, _context=context), "dict", info, None, None
+
+    def _parse_json(self, info, context):
+        return json_loads(info), "dict", None, None, None
+
+    # Response format to the name of the parser method. Formats not listed are
+    # handed to _do_response as is.
+    response_parser = {
+        "jose": "_parse_jose",
+        "jwe": "_parse_jwe",
+        "urlencoded": "_parse_urlencoded",
+        "jwt": "_parse_jwt",
+        "jws": "_parse_jwt",
+        "json": "_parse_json",
+    }
+
     def parse_response(
             self,
             info,
@@ -608,39 +721,17 @@ class Service(ImpExp):
 
         LOGGER.debug("response format: %s", sformat)
 
-        resp = None
-        _jws = _jwe = None
-        if sformat == "jose":  # can be jwe, jws or json
-            # the checks for JWS and JWE will be replaced with functions from cryptojwt
-            _jws = info
-            try:
-                if jws_factory(info):
-                    info = self._do_jwt(info)
-            except:
-                try:
-                    if jwe_factory(info):
-                        info = self._do_jwt(info)
-                except:
-                    LOGGER.debug("jwe detected")
-            if info and isinstance(info, str):
-                info = json.loads(info)
-            sformat = "dict"
-        elif sformat == "jwe":
-            _keyjar = self.upstream_get("attribute", "keyjar")
-            _client_id = self.upstream_get("attribute", "client_id")
-            _jwe = info
-            resp = self.response_cls().from_jwe(info, keys=_keyjar.get_issuer_keys(_client_id))
-        # If format is urlencoded 'info' may be a URL
-        # in which case I have to get at the query/fragment part
-        elif sformat == "urlencoded":
-            info = self.get_urlinfo(info)
-        elif sformat in ["jwt", "jws"]:
-            _jws = info
-            info = self._do_jwt(info)
-            sformat = "dict"
-        elif sformat == "json":
-            info = json.loads(info)
-            sformat = "dict"
+        if sformat == "json" and _looks_like_jwt(info):
+            # A JWS or JWE but wrongly tagged, no need to try it as JSON first.
+            sformat = "jwt"
+
+        _context = self.upstream_get("context")
+
+        _parser = self.response_parser.get(sformat)
+        if _parser:
+            info, sformat, _jws, _jwe, resp = getattr(self, _parser)(info, _context)
+        else:
+            resp = _jws = _jwe = None
 
         LOGGER.debug("response_cls: %s", self.response_cls.__name__)
 
@@ -654,11 +745,13 @@ class Service(ImpExp):
             if sformat == "text":
                 resp = info
             else:
-                resp = self._do_response(info, sformat, **kwargs)
-                if isinstance(resp, Message):
-                    LOGGER.debug(f'Initial response parsing => "{resp.to_dict()}"')
-                else:
-                    LOGGER.debug(f'Initial response parsing => "{resp}"')
+                resp = self._do_response(info, sformat, _context=_context, **kwargs)
+                # to_dict() walks the whole message so only do it if it's going to be logged
+                if LOGGER.isEnabledFor(logging.DEBUG):
+                    if isinstance(resp, Message):
+                        LOGGER.debug('Initial response parsing => "%s"', resp.to_dict())
+                    else:
+                        LOGGER.debug('Initial response parsing => "%s"', resp)
 
         # is this an error message
         if sformat == "text":
@@ -674,7 +767,7 @@ class Service(ImpExp):
             except MissingSigningKey as err:
                 LOGGER.error(f"Could not find an appropriate key: {err}")
                 if vargs["iss"] not in vargs["keyjar"].owners():
-                    LOGGER.debug(f"Issuer {vargs['iss']} not found in keyjar")
+                    LOGGER.debug("Issuer %s not found in keyjar", vargs["iss"])
                 raise
             except Exception as err:
                 LOGGER.error("Got exception while verifying response: %s", err)
@@ -694,12 +787,27 @@ class Service(ImpExp):
         return resp
 
     def supports(self):
-        res = {}
-        for key, val in self._supports.items():
-            if isinstance(val, Callable):
-                res[key] = val()
-            else:
-                res[key] = val
+        """
+        The values that are not callables are collected once. If there are no
+        callables the cached dictionary is returned and must be treated as read-only.
+        """
+        if self._supports_cache is None:
+            _static = {}
+            _dynamic = []
+            for key, val in self._supports.items():
+                if callable(val):
+                    _dynamic.append((key, val))
+                else:
+                    _static[key] = val
+            self._supports_cache = (_static, _dynamic)
+
+        _static, _dynamic = self._supports_cache
+        if not _dynamic:
+            return _static
+
+        res = _static.copy()
+        for key, val in _dynamic:
+            res[key] = val()
         return res
 
     def extends(self, info):
@@ -707,7 +815,7 @@ class Service(ImpExp):
             if claim in info:
                 info[claim].extend(val)
             else:
-                info[claim] = copy.copy(val)
+                info[claim] = val[:] if isinstance(val, list) else copy.copy(val)
         return info
 
     def get_callback_path(self, callback):
@@ -732,15 +840,18 @@ class Service(ImpExp):
             return {}
 
         _callback_uris = context.get_preference("callback_uris", {})
+        # Same format as get_uri
+        _prefix = f"{base_url}/"
+        _suffix = f"/{hex}"
         for uri in targets:
             if uri in _callback_uris:
                 pass
             else:
                 _path = self._callback_path.get(uri)
                 if isinstance(_path, str):
-                    _callback_uris[uri] = self.get_uri(base_url, _path, hex)
+                    _callback_uris[uri] = _prefix + _path + _suffix
                 else:
-                    _callback_uris[uri] = [self.get_uri(base_url, _var, hex) for _var in _path]
+                    _callback_uris[uri] = [_prefix + _var + _suffix for _var in _path]
 
         return _callback_uris
 
@@ -748,7 +859,9 @@ class Service(ImpExp):
         return claim in self._supports
 
     def callback_uris(self):
-        return list(self._callback_path.keys())
+        if self._callback_uris_cache is None:
+            self._callback_uris_cache = list(self._callback_path.keys())
+        return self._callback_uris_cache
 
 
 def init_services(service_definitions, upstream_get):
@@ -1,6 +1,9 @@
 import pytest
+from cryptojwt.jws.exception import NoSuitableSigningKeys
+from cryptojwt.key_jar import build_keyjar
 
 from idpyoidc.client.entity import Entity
+from idpyoidc.client.service import Service
 from idpyoidc.message.oauth2 import AuthorizationResponse
 from idpyoidc.message.oauth2 import Message
 
@@ -109,6 +112,28 @@ class TestService:
             "state": "state",
         }
 
+    def test_get_endpoint_follows_provider_info(self):
+        self.service_context.provider_info = {
+            "authorization_endpoint": "https://op.example.com/authz"
+        }
+        assert self.service.get_endpoint() == "https://op.example.com/authz"
+
+        self.service_context.provider_info = {
+            "authorization_endpoint": "https://op.example.org/authorize"
+        }
+        assert self.service.get_endpoint() == "https://op.example.org/authorize"
+
+        self.service_context.provider_info["authorization_endpoint"] = "https://op.example.net/a"
+        assert self.service.get_endpoint() == "https://op.example.net/a"
+
+    def test_get_urlinfo(self):
+        assert self.service.get_urlinfo("code=abc") == "code=abc"
+        assert self.service.get_urlinfo("https://example.com/cb?code=abc") == "code=abc"
+        assert self.service.get_urlinfo("https://example.com/cb#code=abc") == "code=abc"
+        assert self.service.get_urlinfo("https://example.com/cb?code=abc#foo") == "code=abc"
+        assert self.service.get_urlinfo("https://example.com/cb#code=abc?x=y") == "code=abc?x=y"
+        assert self.service.get_urlinfo("https://example.com/cb?code=a\tbc\r\n") == "code=abc"
+
     def test_parse_response_urlencoded(self):
         resp1 = AuthorizationResponse(code="auth_grant", state="state").to_urlencoded()
         self.service.response_body_type = "urlencoded"
@@ -145,6 +170,70 @@ class TestService:
         assert isinstance(arg, AuthorizationResponse)
         assert arg.to_dict() == {"code": "auth_grant", "state": "state"}
 
+    def test_parse_response_jwt_tagged_as_json(self):
+        self.service.response_cls = AuthorizationResponse
+        self.service_context.issuer = "https://op.example.com/"
+
+        _sign_key = self.service.upstream_get("attribute", "keyjar").get_signing_key()
+        resp1 = AuthorizationResponse(code="auth_grant", state="state").to_jwt(
+            key=_sign_key, algorithm="RS256"
+        )
+        arg = self.service.parse_response(resp1, sformat="json")
+        assert isinstance(arg, AuthorizationResponse)
+        assert arg.to_dict() == {"code": "auth_grant", "state": "state"}
+        assert arg._jws == resp1
+
+    def test_parse_response_extra_format(self):
+        class SemicolonService(Service):
+            response_cls = AuthorizationResponse
+            response_parser = {**Service.response_parser, "semicolon": "_parse_semicolon"}
+
+            def _parse_semicolon(self, info, context):
+                _msg = dict(p.split("=") for p in info.split(";"))
+                return _msg, "dict", None, None, None
+
+        _service = SemicolonService(upstream_get=self.service.upstream_get)
+        self.service_context.issuer = "https://op.example.com/"
+        arg = _service.parse_response("code=auth_grant;state=state", sformat="semicolon")
+        assert isinstance(arg, AuthorizationResponse)
+        assert arg.to_dict() == {"code": "auth_grant", "state": "state"}
+
+    def test_parse_response_overridden_parser(self):
+        class StateService(Service):
+            response_cls = AuthorizationResponse
+
+            def _parse_urlencoded(self, info, context):
+                return f"{info}&state=added", "urlencoded", None, None, None
+
+        _service = StateService(upstream_get=self.service.upstream_get)
+        self.service_context.issuer = "https://op.example.com/"
+        arg = _service.parse_response("code=auth_grant", sformat="urlencoded")
+        assert arg.to_dict() == {"code": "auth_grant", "state": "added"}
+
+    def test_parse_response_jwt_with_newline_tagged_as_json(self):
+        self.service.response_cls = AuthorizationResponse
+        self.service_context.issuer = "https://op.example.com/"
+
+        _sign_key = self.service.upstream_get("attribute", "keyjar").get_signing_key()
+        resp1 = AuthorizationResponse(code="auth_grant", state="state").to_jwt(
+            key=_sign_key, algorithm="RS256"
+        )
+        # Not a compact serialization so it's treated as JSON
+        with pytest.raises(ValueError):
+            self.service.parse_response(resp1 + "\n", sformat="json")
+
+    def test_parse_response_jwt_tagged_as_json_unknown_key(self):
+        self.service.response_cls = AuthorizationResponse
+        self.service_context.issuer = "https://op.example.com/"
+
+        _sign_key = build_keyjar(KEYDEFS).get_signing_key("rsa")
+        resp1 = AuthorizationResponse(code="auth_grant", state="state").to_jwt(
+            key=_sign_key, algorithm="RS256"
+        )
+        # The same error as with sformat="jwt", not a JSON or format error
+        with pytest.raises(NoSuitableSigningKeys):
+            self.service.parse_response(resp1, sformat="json")
+
     def test_parse_response_err(self):
         self.service.response_body_type = "urlencoded"
         self.service.response_cls = AuthorizationResponse
@@ -174,6 +263,34 @@ class TestAuthorization(object):
         assert isinstance(_req, Message)
         assert set(_req.keys()) == {"foo"}
 
+    def test_construct_pipeline_changes(self):
+        _req = self.service.construct(request_args={"foo": "bar"})
+        assert set(_req.keys()) == {"foo"}
+
+        def add_bar(request_args, **kwargs):
+            request_args["bar"] = "foo"
+            return request_args, {}
+
+        def add_xyz(request, **kwargs):
+            request["xyz"] = "zyx"
+            return request
+
+        self.service.pre_construct.append(add_bar)
+        self.service.post_construct.append(add_xyz)
+        _req = self.service.construct(request_args={"foo": "bar"})
+        assert set(_req.keys()) == {"foo", "bar", "xyz"}
+
+    def test_construct_leaves_request_args_alone(self):
+        self.service.default_request_args = {"scope": ["openid"]}
+        req_args = {"foo": "bar"}
+        _req = self.service.construct(request_args=req_args)
+        assert set(_req.keys()) == {"foo", "scope"}
+        assert req_args == {"foo": "bar"}
+
+        self.service.endpoint = "https://example.com/authorize"
+        self.service.get_request_parameters(request_args=req_args)
+        assert req_args == {"foo": "bar"}
+
     def test_get_request_parameters(self):
         req_args = {"response_type": "code"}
         self.service.endpoint = "https://example.com/authorize"
@@ -1163,6 +1163,13 @@ class TestUserInfo(object):
         )
         assert _resp
 
+    def test_unpack_signed_response_jose(self):
+        resp = OpenIDSchema(sub="diana", given_name="Diana", family_name="krall", iss=ISS)
+        sk = ISS_KEY.get_signing_key("rsa", issuer_id=ISS)
+        alg = self.service.upstream_get("context").get_sign_alg("userinfo")
+        _resp = self.service.parse_response(resp.to_jwt(sk, algorithm=alg), state="abcde")
+        assert _resp["sub"] == "diana"
+
     def test_unpack_encrypted_response(self):
         # Add encryption key
         _kj = build_keyjar([{"type": "RSA", "use": ["enc"]}], issuer_id="")